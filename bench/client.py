@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+"""Benchmarks the FriendFeed client's hot paths.
+
+For each of a few synthetic feeds, and each feed recorded with
+bench/replay.py if a fixture directory is given, this times:
+
+    json/<decoder>  parse_json with each of JSON_DECODERS
+    unicodify       _unicodify of a feed decoded to byte strings
+    dates           _parse_dates
+    parse/anon      _parse_feed for an anonymous session
+    parse/auth      _parse_feed for a signed-in session
+    likes           _likes_first, the part of parse/auth that anon skips
+
+and, once, building the URL, cache key and headers of a request. It prints
+operations per second and the peak memory one call added to the process,
+measured in a forked child so benchmarks do not share a peak.
+
+With --save the results become the baseline; later runs compare against
+it and exit with status 1 if anything got slower by more than --threshold.
+Run from the top of the tree; without DJANGO_SETTINGS_MODULE the client
+uses the settings in standalone.py:
+
+    python bench/client.py --save
+    (change the client)
+    python bench/client.py
+"""
+
+import cPickle as pickle
+import optparse
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import standalone
+import friendfeed
+import synthetic
+from django.utils import simplejson
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "baseline.json")
+
+# Synthetic feeds, as arguments to synthetic.generate
+FEEDS = {
+    "small": {"entries": 30, "comments": 3, "likes": 3},
+    "medium": {"entries": 30, "comments": 50, "likes": 100, "media": 2},
+    "large": {"entries": 30, "comments": 500, "likes": 1000, "media": 4},
+}
+
+
+def _bodies(fixtures=None):
+    """Returns (name, JSON body) pairs of the feeds to benchmark."""
+    bodies = []
+    for name, sizes in sorted(FEEDS.items()):
+        session = friendfeed.FriendFeed("bret", "key",
+            transport=synthetic.transport(**sizes))
+        session.cache = None
+        url = session._url("/api/feed/home", {"num": sizes["entries"]})
+        payload, method, headers = session._request(None)
+        response = session.transport.start(url, payload, method, headers)()
+        bodies.append((name, response.content))
+    if fixtures:
+        for filename in sorted(os.listdir(fixtures)):
+            f = open(os.path.join(fixtures, filename))
+            try:
+                fixture = simplejson.loads(f.read())
+            finally:
+                f.close()
+            if '"entries"' in fixture["content"]:
+                bodies.append((filename[:8],
+                               fixture["content"].encode("utf-8")))
+    return bodies
+
+
+def _utf8(json):
+    """Returns a copy of the given JSON with unicode strings as UTF-8."""
+    if isinstance(json, unicode):
+        return json.encode("utf-8")
+    elif isinstance(json, dict):
+        return dict((_utf8(k), _utf8(v)) for k, v in json.iteritems())
+    elif isinstance(json, list):
+        return [_utf8(v) for v in json]
+    return json
+
+
+def _benchmarks(body):
+    """Returns (name, setup, function) triples for the given feed body.
+
+    Each run calls function(setup()), timing only function, since most of
+    these change the feed they are given.
+    """
+    pickled = pickle.dumps(simplejson.loads(body), 2)
+    pickled_utf8 = pickle.dumps(_utf8(simplejson.loads(body)), 2)
+    anonymous = friendfeed.FriendFeed(cache=False, lazy_dates=False,
+                                      models=False)
+    # Sign in as the last liker of the first entry, the slowest to find
+    likers = [like["user"]["nickname"] for entry in
+              simplejson.loads(body).get("entries", [])[:1]
+              for like in entry.get("likes", [])[-1:]] or ["user1"]
+    signed_in = friendfeed.FriendFeed(likers[0], "key", cache=False,
+                                      lazy_dates=False, models=False)
+    benchmarks = []
+    for name, decoder in sorted(friendfeed.JSON_DECODERS.items()):
+        benchmarks.append(("json/" + name, lambda: body, decoder))
+    benchmarks.extend([
+        ("unicodify", lambda: pickle.loads(pickled_utf8),
+         friendfeed._unicodify),
+        ("dates", lambda: pickle.loads(pickled), anonymous._parse_dates),
+        ("parse/anon", lambda: pickle.loads(pickled), anonymous._parse_feed),
+        ("parse/auth", lambda: pickle.loads(pickled), signed_in._parse_feed),
+        ("likes", lambda: pickle.loads(pickled),
+         lambda feed: friendfeed._likes_first(feed, likers[0])),
+    ])
+    return benchmarks
+
+
+def _request_benchmark():
+    session = friendfeed.FriendFeed("bret", "key", cache=False)
+    def request(post_args):
+        url = session._url("/api/feed/home", {"start": 30, "num": 30})
+        session._cache_key(url)
+        session._request(post_args)
+    return ("request", lambda: None, request)
+
+
+def measure(setup, function, seconds=0.5, repeat=5):
+    """Returns the best operations per second of function(setup()) and the
+    peak memory in KB one call added, from a forked child process.
+    """
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        try:
+            arg = setup()
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            function(arg)
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+            del arg
+            # Find a number of calls that takes about seconds / repeat
+            number = 1
+            while True:
+                args = [setup() for i in xrange(number)]
+                start = time.time()
+                for arg in args:
+                    function(arg)
+                elapsed = time.time() - start
+                if elapsed * repeat >= seconds or number >= 1 << 20:
+                    break
+                number *= 2
+            best = elapsed
+            for i in xrange(repeat - 1):
+                args = [setup() for i in xrange(number)]
+                start = time.time()
+                for arg in args:
+                    function(arg)
+                best = min(best, time.time() - start)
+            os.write(write, "%r %r" % (number / max(best, 1e-9), peak))
+        finally:
+            os._exit(0)
+    os.close(write)
+    output = ""
+    while True:
+        chunk = os.read(read, 4096)
+        if not chunk:
+            break
+        output += chunk
+    os.close(read)
+    os.waitpid(pid, 0)
+    if not output:
+        raise RuntimeError("benchmark process failed")
+    ops, peak = output.split()
+    return float(ops), int(peak)
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--fixtures", help="also benchmark the feeds recorded "
+                      "in this directory by bench/replay.py")
+    parser.add_option("--baseline", default=BASELINE,
+                      help="baseline file [%default]")
+    parser.add_option("--save", action="store_true",
+                      help="save the results as the new baseline")
+    parser.add_option("--threshold", type="float", default=0.1,
+                      help="flag benchmarks this much slower than the "
+                      "baseline [%default]")
+    parser.add_option("--seconds", type="float", default=0.5,
+                      help="time to spend on each benchmark [%default]")
+    options, args = parser.parse_args()
+
+    baseline = {}
+    if not options.save and os.path.exists(options.baseline):
+        f = open(options.baseline)
+        try:
+            baseline = simplejson.loads(f.read())
+        finally:
+            f.close()
+
+    runs = [("-", _request_benchmark())]
+    for feed, body in _bodies(options.fixtures):
+        runs.extend((feed, benchmark) for benchmark in _benchmarks(body))
+
+    results = {}
+    regressions = 0
+    print "%-8s %-16s %12s %10s %10s" % ("feed", "benchmark", "ops/sec",
+                                         "peak KB", "baseline")
+    for feed, (name, setup, function) in runs:
+        ops, peak = measure(setup, function, options.seconds)
+        key = "%s %s" % (feed, name)
+        results[key] = ops
+        change = ""
+        if key in baseline:
+            ratio = ops / baseline[key] - 1
+            change = "%+9.1f%%" % (ratio * 100)
+            if ratio < -options.threshold:
+                change += " REGRESSION"
+                regressions += 1
+        print "%-8s %-16s %12.1f %10d %s" % (feed, name, ops, peak, change)
+
+    if options.save:
+        f = open(options.baseline, "w")
+        try:
+            f.write(simplejson.dumps(results, indent=1, sort_keys=True))
+        finally:
+            f.close()
+        print "Saved the baseline to", options.baseline
+    elif regressions:
+        print "%d benchmark(s) slower than the baseline by more than %d%%" % (
+            regressions, options.threshold * 100)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
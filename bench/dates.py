@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""Compares the FriendFeed client's date parser with time.strptime.
+
+Run from the top of the tree:
+
+    python bench/dates.py
+"""
+
+import datetime
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import standalone
+import friendfeed
+
+
+def _dates(n, distinct):
+    start = datetime.datetime(2009, 1, 1)
+    return [(start + datetime.timedelta(seconds=37 * (i % distinct)))
+            .strftime("%Y-%m-%dT%H:%M:%SZ") for i in range(n)]
+
+
+def _strptime(dates):
+    rfc3339_date = "%Y-%m-%dT%H:%M:%SZ"
+    for date_str in dates:
+        datetime.datetime(*time.strptime(date_str, rfc3339_date)[:6])
+
+
+def _fast(dates):
+    friendfeed._date_memo.clear()
+    parse_date = friendfeed._parse_rfc3339
+    for date_str in dates:
+        parse_date(date_str)
+
+
+def main(repeat=20):
+    print "msec per 1,000 dates (best of %d)" % repeat
+    for label, dates in (("all distinct", _dates(1000, 1000)),
+                         ("100 distinct", _dates(1000, 100))):
+        for name, function in (("strptime", _strptime),
+                               ("_parse_rfc3339", _fast)):
+            timer = timeit.Timer(lambda: function(dates))
+            best = min(timer.repeat(repeat, 1))
+            print "%-14s %-16s %8.3f" % (label, name, best * 1000)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+"""Records FriendFeed API responses and replays them without the network.
+
+RecordingTransport wraps a real transport and saves each response it sees
+as a fixture in a directory. Credentials never reach the fixtures: the
+apikey argument is dropped from URLs, request headers are not kept and
+only the Content-Type response header is. ReplayTransport serves the
+fixtures back with a latency drawn from a distribution of your choosing,
+so a benchmark run sees the same data and the same kind of delays every
+time. Pass either one as the transport of a FriendFeed session:
+
+    session = friendfeed.FriendFeed(transport=RecordingTransport("fixtures"))
+    session = friendfeed.FriendFeed(
+        transport=ReplayTransport("fixtures", latency=lognormal(0.2, 0.5)))
+
+To record a corpus of the feeds fftogo shows, run from the top of the tree:
+
+    python bench/replay.py fixtures nickname remote_key
+"""
+
+import hashlib
+import math
+import os
+import random
+import sys
+import time
+import urllib
+import urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import standalone
+import friendfeed
+from django.utils import simplejson
+
+# Query arguments that identify the caller rather than the data
+PRIVATE_ARGS = ("apikey",)
+
+
+def fixture_key(url, method):
+    """Returns the name of the fixture for a request.
+
+    POSTs are keyed by path alone, since their payloads differ every time.
+    """
+    scheme, host, path, query, fragment = urlparse.urlsplit(url)
+    if method == "POST":
+        return "%s %s" % (method, path)
+    args = [(name, value) for name, value in urlparse.parse_qsl(query)
+            if name not in PRIVATE_ARGS]
+    args.sort()
+    return "%s %s?%s" % (method, path, urllib.urlencode(args))
+
+
+def _fixture_path(directory, key):
+    return os.path.join(directory, hashlib.md5(key).hexdigest() + ".json")
+
+
+def constant(seconds):
+    """Returns a latency distribution that always takes the given time."""
+    return lambda: seconds
+
+
+def lognormal(median, sigma):
+    """Returns a log-normal latency distribution with the given median.
+
+    Real API latencies have a long tail; a sigma of 0.5 puts p99 at about
+    three times the median.
+    """
+    mu = math.log(median)
+    return lambda: random.lognormvariate(mu, sigma)
+
+
+class _Recording(object):
+    """A request in flight whose response is saved once it arrives."""
+    def __init__(self, call, save):
+        self._call = call
+        self._save = save
+        self._saved = False
+        if hasattr(call, "wait"):
+            # Keep the call hedgeable; see friendfeed._hedge
+            self.wait = call.wait
+
+    def __call__(self):
+        response = self._call()
+        if not self._saved:
+            self._saved = True
+            self._save(response)
+        return response
+
+
+class RecordingTransport(object):
+    """Sends requests through another transport and saves the responses."""
+    def __init__(self, directory, transport=None):
+        self.directory = directory
+        self.transport = transport or friendfeed._default_transport()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def start(self, url, payload, method, headers, timeout=None):
+        """Starts a request and returns a callable that waits for it."""
+        key = fixture_key(url, method)
+        def save(response):
+            fixture = {
+                "key": key,
+                "status_code": response.status_code,
+                "content_type": response.headers.get("content-type",
+                                                     "text/javascript"),
+                "content": response.content.decode("utf-8"),
+            }
+            f = open(_fixture_path(self.directory, key), "w")
+            try:
+                f.write(simplejson.dumps(fixture))
+            finally:
+                f.close()
+        return _Recording(self.transport.start(url, payload, method, headers,
+                                               timeout), save)
+
+
+class ReplayTransport(object):
+    """Serves recorded responses after a simulated network delay.
+
+    latency is a function returning the delay of each call in seconds; see
+    constant and lognormal. Requests with no fixture get a 404, as an
+    unknown feed would from friendfeed.com.
+    """
+    def __init__(self, directory, latency=None):
+        self.directory = directory
+        self.latency = latency or constant(0)
+        self._fixtures = {}
+
+    def start(self, url, payload, method, headers, timeout=None):
+        """Starts a request and returns a callable that waits for it."""
+        return friendfeed._thread_pool.submit(self._serve, url, method)
+
+    def _serve(self, url, method):
+        time.sleep(self.latency())
+        fixture = self._fixture(fixture_key(url, method))
+        if fixture is None:
+            return friendfeed._Response(404, '{"errorCode": "not-found"}',
+                                        {"content-type": "text/javascript"})
+        return friendfeed._Response(fixture["status_code"],
+            fixture["content"], {"content-type": fixture["content_type"]})
+
+    def _fixture(self, key):
+        if key not in self._fixtures:
+            path = _fixture_path(self.directory, key)
+            if os.path.exists(path):
+                f = open(path)
+                try:
+                    fixture = simplejson.loads(f.read())
+                finally:
+                    f.close()
+                fixture["content"] = fixture["content"].encode("utf-8")
+                self._fixtures[key] = fixture
+            else:
+                self._fixtures[key] = None
+        return self._fixtures[key]
+
+
+def record(directory, nickname, remote_key):
+    """Records the feeds and profiles fftogo's main pages fetch."""
+    session = friendfeed.FriendFeed(nickname, remote_key,
+                                    transport=RecordingTransport(directory))
+    session.cache = None
+    profile = session.fetch_user_profile(nickname)
+    feeds = [session.fetch_home_feed(), session.fetch_public_feed(),
+             session.fetch_user_feed(nickname),
+             session.fetch_user_discussion_feed(nickname)]
+    for room in profile.get("rooms", [])[:5]:
+        feeds.append(session.fetch_room_feed(room["nickname"]))
+    for list in profile.get("lists", [])[:5]:
+        feeds.append(session.fetch_list_feed(list["nickname"]))
+    for feed in feeds:
+        for entry in feed.get("entries", [])[:5]:
+            session.fetch_entry(entry["id"])
+    print "Recorded %d fixtures in %s" % (len(os.listdir(directory)),
+                                          directory)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4:
+        print >> sys.stderr, __doc__
+        sys.exit(1)
+    record(*sys.argv[1:])
@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+"""A local stand-in for the parts of friendfeed.com that fftogo uses.
+
+It serves the /api/feed/*, /api/user/*/profile, /api/room/*/profile and
+/api/list/*/profile reads and the /api/comment, /api/like and /api/entry/hide
+writes from an in-memory Store, after an optional simulated delay.
+StoreTransport answers from a Store in the same process instead. Run the
+server from the top of the tree and point the client at it:
+
+    python bench/server.py 8081
+
+    # settings.py
+    FRIENDFEED_URL = "http://localhost:8081"
+"""
+
+import BaseHTTPServer
+import base64
+import cgi
+import datetime
+import os
+import re
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import standalone
+import friendfeed
+from django.utils import simplejson
+
+RFC3339 = "%Y-%m-%dT%H:%M:%SZ"
+
+SERVICES = {
+    "internal": "FriendFeed",
+    "twitter": "Twitter",
+    "blog": "Blog",
+    "flickr": "Flickr",
+    "googlereader": "Google Reader",
+}
+
+
+def user(nickname):
+    """Returns the FriendFeed description of the given user."""
+    return {
+        "id": "%032x" % (hash(nickname) & (2 ** 128 - 1)),
+        "name": nickname.capitalize(),
+        "nickname": nickname,
+        "profileUrl": "http://friendfeed.com/" + nickname,
+    }
+
+
+def service(id):
+    """Returns the FriendFeed description of the given service."""
+    return {
+        "id": id,
+        "name": SERVICES.get(id, id),
+        "iconUrl": "http://friendfeed.com/static/images/icons/%s.png" % id,
+        "profileUrl": "http://friendfeed.com/",
+    }
+
+
+class Store(object):
+    """Entries, users, rooms and lists, newest entry first.
+
+    Each entry may carry "_room" and "_list" nicknames saying which room
+    feed and list feed it appears in, and a "_hidden_by" list of the users
+    who hid it; they are not sent to clients.
+    """
+    def __init__(self, entries=None):
+        self.entries = entries or self._sample()
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+    def _sample(self):
+        now = datetime.datetime.utcnow()
+        nicknames = ["bret", "paul", "jim", "sanjeev", "kevin"]
+        entries = []
+        for i in range(60):
+            author = nicknames[i % len(nicknames)]
+            date = (now - datetime.timedelta(minutes=7 * i)).strftime(RFC3339)
+            entries.append({
+                "id": "00000000-0000-0000-0000-%012d" % i,
+                "title": "Sample entry %d" % i,
+                "link": "http://friendfeed.com/e/%d" % i,
+                "published": date,
+                "updated": date,
+                "user": user(author),
+                "service": service(SERVICES.keys()[i % len(SERVICES)]),
+                "comments": [{"id": "c%d-%d" % (i, j), "date": date,
+                              "user": user(nicknames[j % len(nicknames)]),
+                              "body": "Comment %d" % j}
+                             for j in range(i % 4)],
+                "likes": [{"date": date,
+                           "user": user(nicknames[j % len(nicknames)])}
+                          for j in range(i % 3)],
+                "media": [],
+                "hidden": False,
+                "anonymous": False,
+                "_room": i % 5 == 0 and "friendfeed-feedback" or None,
+                "_list": i % 2 == 0 and "favorites" or None,
+            })
+        return entries
+
+    def get(self, path, args, nickname):
+        """Returns the JSON response to the given read, or None for a 404."""
+        match = re.match(r"^/api/(user|room|list)/([^/]+)/profile$", path)
+        if match:
+            return self.profile(*match.groups())
+        elif path == "/api/validate":
+            return {}
+        elif path.startswith("/api/feed/"):
+            entries = self.feed(path, args, nickname)
+            if entries is not None:
+                return {"entries": entries}
+        return None
+
+    def feed(self, path, args, nickname):
+        """Returns the entries of the feed at the given /api/feed/ path."""
+        match = re.match(r"^/api/feed/(user|room|list)/([^/]+)(?:/(\w+))?$",
+                         path)
+        if match:
+            kind, name, sub = match.groups()
+            if kind == "room":
+                entries = [e for e in self.entries if e["_room"] == name]
+            elif kind == "list":
+                entries = [e for e in self.entries if e["_list"] == name]
+            elif sub == "comments":
+                entries = [e for e in self.entries if
+                           [c for c in e["comments"]
+                            if c["user"]["nickname"] == name]]
+            elif sub == "likes":
+                entries = [e for e in self.entries if
+                           [l for l in e["likes"]
+                            if l["user"]["nickname"] == name]]
+            else:
+                entries = [e for e in self.entries
+                           if e["user"]["nickname"] == name]
+        elif path.startswith("/api/feed/entry"):
+            if path.startswith("/api/feed/entry/"):
+                ids = [path[len("/api/feed/entry/"):]]
+            else:
+                ids = args.get("entry_id", "").split(",")
+            entries = [e for e in self.entries if e["id"] in ids]
+        elif path == "/api/feed/user":
+            names = args.get("nickname", "").split(",")
+            entries = [e for e in self.entries
+                       if e["user"]["nickname"] in names]
+        elif path == "/api/feed/rooms":
+            entries = [e for e in self.entries if e["_room"]]
+        elif path == "/api/feed/search":
+            q = args.get("q", "").lower()
+            entries = [e for e in self.entries if q in e["title"].lower()]
+        elif path in ("/api/feed/home", "/api/feed/public", "/api/feed/url"):
+            entries = self.entries
+        else:
+            return None
+        if "service" in args:
+            entries = [e for e in entries
+                       if e["service"]["id"] == args["service"]]
+        start = int(args.get("start", 0))
+        num = int(args.get("num", 30))
+        return [self._public(e, nickname) for e in entries[start:start + num]]
+
+    def _public(self, entry, nickname):
+        public = dict((k, v) for k, v in entry.items() if not k.startswith("_"))
+        public["hidden"] = nickname in entry.get("_hidden_by", ())
+        return public
+
+    def profile(self, kind, name):
+        """Returns the profile of the given user, room or list."""
+        profile = user(name)
+        if kind == "user":
+            profile["subscriptions"] = [user(e["user"]["nickname"])
+                                        for e in self.entries[:5]]
+            profile["rooms"] = [{"nickname": "friendfeed-feedback",
+                                 "name": "FriendFeed Feedback"}]
+            profile["lists"] = [{"nickname": "favorites",
+                                 "name": "Favorites"}]
+            profile["services"] = [service(id) for id in SERVICES]
+        else:
+            profile["members"] = [user(e["user"]["nickname"])
+                                  for e in self.entries[:5]]
+        return profile
+
+    def post(self, path, args, nickname):
+        """Applies the given write and returns its JSON response."""
+        self._lock.acquire()
+        try:
+            entry = None
+            for e in self.entries:
+                if e["id"] == args.get("entry"):
+                    entry = e
+            if entry is None:
+                return None
+            now = datetime.datetime.utcnow().strftime(RFC3339)
+            if path == "/api/comment":
+                if "comment" in args:
+                    for comment in entry["comments"]:
+                        if comment["id"] == args["comment"]:
+                            comment["body"] = args.get("body", "")
+                    return {"id": args["comment"]}
+                self._next_id += 1
+                id = "new-%d" % self._next_id
+                entry["comments"].append({"id": id, "date": now,
+                                          "user": user(nickname),
+                                          "body": args.get("body", "")})
+                entry["updated"] = now
+                return {"id": id}
+            elif path == "/api/comment/delete":
+                entry["comments"] = [c for c in entry["comments"]
+                                     if c["id"] != args.get("comment")]
+            elif path == "/api/like":
+                entry["likes"].append({"date": now, "user": user(nickname)})
+            elif path == "/api/like/delete":
+                entry["likes"] = [l for l in entry["likes"]
+                                  if l["user"]["nickname"] != nickname]
+            elif path == "/api/entry/hide":
+                hidden = entry.setdefault("_hidden_by", [])
+                if args.get("unhide"):
+                    if nickname in hidden:
+                        hidden.remove(nickname)
+                else:
+                    hidden.append(nickname)
+            else:
+                return None
+            return {}
+        finally:
+            self._lock.release()
+
+
+def _nickname(authorization):
+    """Returns the user named in a Basic Authorization header, if any."""
+    if not authorization or not authorization.startswith("Basic "):
+        return None
+    return base64.b64decode(authorization[6:]).split(":", 1)[0]
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers API requests from the server's store."""
+    def do_GET(self):
+        path, args = self._parse(urlparse.urlsplit(self.path)[3])
+        self._send(self.server.store.get(path, args, self._nickname()))
+
+    def do_POST(self):
+        length = int(self.headers.getheader("content-length") or 0)
+        path, args = self._parse(self.rfile.read(length))
+        self._send(self.server.store.post(path, args, self._nickname()))
+
+    def _parse(self, query):
+        path = urlparse.urlsplit(self.path)[2]
+        args = dict((k, v[-1]) for k, v in cgi.parse_qs(query).items())
+        return path, args
+
+    def _nickname(self):
+        return _nickname(self.headers.getheader("authorization"))
+
+    def _send(self, data):
+        time.sleep(self.server.latency())
+        if data is None:
+            status, data = 404, {"errorCode": "not-found"}
+        else:
+            status = 200
+        body = simplejson.dumps(data)
+        self.send_response(status)
+        self.send_header("Content-Type", "text/javascript; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves a Store over HTTP/1.1, one thread per connection.
+
+    latency is a function returning the delay of each response in seconds,
+    such as bench.replay.lognormal(0.2, 0.5).
+    """
+    daemon_threads = True
+
+    def __init__(self, address, store=None, latency=None):
+        Handler.protocol_version = "HTTP/1.1"
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.store = store or Store()
+        self.latency = latency or (lambda: 0)
+
+
+class StoreTransport(object):
+    """Answers the client's requests from a Store without a socket.
+
+    Use it as the transport of a FriendFeed session to measure the client
+    and the views without HTTP overhead; latency is as for Server.
+    """
+    def __init__(self, store=None, latency=None):
+        self.store = store or Store()
+        self.latency = latency or (lambda: 0)
+
+    def start(self, url, payload, method, headers, timeout=None):
+        """Starts a request and returns a callable that waits for it."""
+        return friendfeed._thread_pool.submit(self._serve, url, payload,
+                                              method, headers)
+
+    def _serve(self, url, payload, method, headers):
+        time.sleep(self.latency())
+        scheme, host, path, query, fragment = urlparse.urlsplit(url)
+        args = dict((k, v[-1]) for k, v in cgi.parse_qs(query).items())
+        nickname = _nickname(headers.get("Authorization"))
+        if method == "POST":
+            args.update((k, v[-1]) for k, v in
+                        cgi.parse_qs(payload or "").items())
+            data = self.store.post(path, args, nickname)
+        else:
+            data = self.store.get(path, args, nickname)
+        if data is None:
+            return friendfeed._Response(404, '{"errorCode": "not-found"}', {})
+        return friendfeed._Response(200, simplejson.dumps(data), {})
+
+
+def serve_in_background(port=0, store=None, latency=None):
+    """Starts a Server on a daemon thread and returns it.
+
+    The server's URL, for settings.FRIENDFEED_URL, is
+    "http://localhost:%d" % server.server_port.
+    """
+    server = Server(("localhost", port), store, latency)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    port = len(sys.argv) > 1 and int(sys.argv[1]) or 8081
+    print "Serving the FriendFeed API on http://localhost:%d" % port
+    Server(("localhost", port)).serve_forever()
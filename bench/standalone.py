@@ -0,0 +1,20 @@
+"""Lets the bench scripts run without a Django settings module.
+
+friendfeed reads its options from django.conf.settings, which Django will
+not do unless DJANGO_SETTINGS_MODULE is set or settings.configure() has
+been called. Importing this module, before friendfeed, calls configure()
+if neither has happened, with settings suited to benchmarks: no metrics,
+no response cache and no rate limits, so each run measures the client
+itself. With DJANGO_SETTINGS_MODULE set, that module is used as is.
+"""
+
+import os
+
+from django.conf import settings
+
+if not os.environ.get("DJANGO_SETTINGS_MODULE") and not settings.configured:
+    settings.configure(
+        FRIENDFEED_METRICS=None,
+        FRIENDFEED_CACHE=False,
+        FRIENDFEED_RATE_LIMITS={},
+    )
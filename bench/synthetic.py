@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""Generates FriendFeed-shaped feeds of any size for scale testing.
+
+generate returns entries for a bench.server.Store, so a synthetic feed can
+be served over HTTP by bench/server.py or straight to a FriendFeed session
+through a StoreTransport:
+
+    session = friendfeed.FriendFeed("bret", "key",
+                                    transport=transport(comments=500))
+
+Run from the top of the tree to time the client's feed parsing as each
+size grows on its own:
+
+    python bench/synthetic.py
+
+Without DJANGO_SETTINGS_MODULE the client runs with the settings in
+standalone.py and rendering is skipped. Point DJANGO_SETTINGS_MODULE at
+settings whose TEMPLATE_DIRS include templates/ to time the rendering of
+entries.html too; FRIENDFEED_CACHE should be off in them.
+"""
+
+import datetime
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import standalone
+import friendfeed
+import server
+
+# The share of entries from each service when none is given
+SERVICE_MIX = {
+    "internal": 0.4,
+    "twitter": 0.3,
+    "blog": 0.1,
+    "flickr": 0.1,
+    "googlereader": 0.1,
+}
+
+# The sizes main times, each varied while the others stay at DEFAULTS
+DEFAULTS = {"entries": 30, "comments": 3, "likes": 3, "media": 0}
+SIZES = {
+    "entries": (10, 30, 100),
+    "comments": (0, 50, 500),
+    "likes": (0, 100, 1000),
+    "media": (0, 4, 16),
+}
+
+
+def generate(entries=30, comments=3, likes=3, media=0, services=None,
+             hidden=0.0, viewer="bret", users=50, seed=0):
+    """Returns a list of entries, newest first.
+
+    Each entry has the given number of comments, likes and media items,
+    from a service picked by the weights in services (SERVICE_MIX by
+    default). Each entry is hidden from viewer with probability hidden.
+    Authors, commenters and likers are drawn from users distinct people;
+    more are made up if an entry has more likes than that. The same seed
+    always gives the same feed.
+    """
+    rand = random.Random(seed)
+    services = services or SERVICE_MIX
+    weights = sorted(services.items())
+    total = float(sum(weight for id, weight in weights))
+    people = [server.user("user%d" % i) for i in range(max(users, likes))]
+    now = datetime.datetime(2009, 6, 1)
+    result = []
+    for i in range(entries):
+        published = now - datetime.timedelta(minutes=5 * i)
+        date = published.strftime(server.RFC3339)
+        pick = rand.random() * total
+        for service_id, weight in weights:
+            pick -= weight
+            if pick < 0:
+                break
+        entry_id = "%08x-0000-0000-0000-%012d" % (seed, i)
+        entry = {
+            "id": entry_id,
+            "title": "Synthetic entry %d with a title long enough to wrap "
+                     "on a phone, http://example.com/%d" % (i, i),
+            "link": "http://example.com/%d" % i,
+            "published": date,
+            "updated": date,
+            "user": rand.choice(people[:users]),
+            "service": server.service(service_id),
+            "comments": [],
+            "likes": [],
+            "media": [],
+            "anonymous": False,
+            "_room": None,
+            "_list": None,
+        }
+        for j in range(comments):
+            entry["comments"].append({
+                "id": "%s-c%d" % (entry_id, j),
+                "date": (published + datetime.timedelta(seconds=j))
+                        .strftime(server.RFC3339),
+                "user": rand.choice(people[:users]),
+                "body": "Comment %d on entry %d" % (j, i),
+            })
+        for person in rand.sample(people, likes):
+            entry["likes"].append({"date": date, "user": person})
+        for j in range(media):
+            url = "http://example.com/%d/%d.jpg" % (i, j)
+            entry["media"].append({
+                "title": "Photo %d" % j,
+                "link": url,
+                "thumbnails": [{"url": url, "width": 75, "height": 75}],
+                "content": [{"url": url, "type": "image/jpeg",
+                             "width": 640, "height": 480}],
+            })
+        if rand.random() < hidden:
+            entry["_hidden_by"] = [viewer]
+        result.append(entry)
+    return result
+
+
+def transport(latency=None, **kwargs):
+    """Returns a StoreTransport serving a feed made by generate(**kwargs)."""
+    return server.StoreTransport(server.Store(generate(**kwargs)), latency)
+
+
+class _Request(object):
+    """Just enough of an HttpRequest for entries.html."""
+    path = "/"
+    GET = {}
+    session = {"nickname": "bret"}
+
+
+def _renderer():
+    """Returns a function rendering a feed with entries.html, or None if
+    Django is not configured.
+    """
+    if not os.environ.get("DJANGO_SETTINGS_MODULE"):
+        return None
+    from django.template import loader
+    def render(feed):
+        loader.render_to_string("entries.html", {
+            "entries": feed["entries"],
+            "request": _Request(),
+        })
+    return render
+
+
+def main(repeat=5):
+    render = _renderer()
+    print "msec per feed (best of %d)" % repeat
+    print "%-10s %6s %10s %10s" % ("size", "n", "fetch", "render")
+    for name in sorted(SIZES):
+        for n in SIZES[name]:
+            sizes = dict(DEFAULTS)
+            sizes[name] = n
+            session = friendfeed.FriendFeed("bret", "key",
+                                            transport=transport(**sizes))
+            session.cache = None
+            fetch = lambda: session.fetch_home_feed(num=sizes["entries"])
+            best = min(timeit.Timer(fetch).repeat(repeat, 1))
+            if render:
+                feed = fetch()
+                rendered = min(timeit.Timer(lambda: render(feed))
+                               .repeat(repeat, 1))
+                rendered = "%10.2f" % (rendered * 1000)
+            else:
+                rendered = "%10s" % "-"
+            print "%-10s %6d %10.2f %s" % (name, n, best * 1000, rendered)
+
+
+if __name__ == "__main__":
+    main()
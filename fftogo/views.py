@@ -1,14 +1,28 @@
+import calendar
+import hashlib
 import logging
 import friendfeed
+import math
+import random
+import time
 import urllib
 from django.conf import settings
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse, HttpResponseRedirect, Http404
+from django.http import HttpResponse, HttpResponseNotModified, HttpResponseRedirect, Http404
 from django.shortcuts import render_to_response
 from django.template import RequestContext
-from django.utils import feedgenerator
+from django.utils import feedgenerator, simplejson
+from email.utils import formatdate, mktime_tz, parsedate_tz
 from fftogo.forms import CommentForm, LoginForm, SearchForm, SettingsForm
 from google.appengine.api import memcache
+from google.appengine.api import users
+try:
+    from google.appengine.api import taskqueue
+except ImportError:
+    try:
+        from google.appengine.api.labs import taskqueue
+    except ImportError:
+        taskqueue = None
 
 PUBLIC_CACHE_TIME = settings.PUBLIC_CACHE_TIME
 FONT_SIZE = settings.FONT_SIZE
@@ -18,6 +32,35 @@ NEW_WINDOW = settings.NEW_WINDOW
 NUM = settings.NUM
 VIA = settings.VIA
 NO_MEDIA = settings.NO_MEDIA
+PREFETCH = getattr(settings, 'FRIENDFEED_PREFETCH', False)
+# The most feed pages home fetches to fill one page of unhidden entries
+HOME_MAX_PAGES = getattr(settings, 'HOME_MAX_PAGES', 4)
+# How long a "Next" link's cursor is kept
+CURSOR_TIME = getattr(settings, 'CURSOR_TIME', 30 * 60)
+# How long past PUBLIC_CACHE_TIME the public feed may be shown while it is
+# refreshed in the background
+PUBLIC_GRACE_TIME = getattr(settings, 'PUBLIC_GRACE_TIME', 10 * 60)
+# How long a signed in user's rendered feed pages are kept
+PAGE_CACHE_TIME = getattr(settings, 'PAGE_CACHE_TIME', 60)
+# How long a queued prefetch can still get the credentials it runs with
+PREFETCH_TOKEN_TIME = 10 * 60
+
+# Session settings that change how a page renders
+DISPLAY_SETTINGS = ('fontsize', 'googlemobileproxy', 'newwindow', 'nomedia', 'num')
+
+# FriendFeed methods the prefetch task may call
+PREFETCH_METHODS = frozenset([
+    'fetch_home_feed',
+    'fetch_list_feed',
+    'fetch_room_feed',
+    'fetch_rooms_feed',
+    'fetch_url_feed',
+    'fetch_user_comments_feed',
+    'fetch_user_discussion_feed',
+    'fetch_user_feed',
+    'fetch_user_friends_feed',
+    'fetch_user_likes_feed',
+])
 
 def querydict_to_dict(arguments):
     kwargs = {}
@@ -47,6 +90,206 @@ def get_integer_argument(request, name, default):
     except (TypeError, ValueError):
         return default
 
+def request_priority(request):
+    '''Return the FriendFeed API priority for a request.
+
+    Atom output is polled by feed readers, so it gives way to page loads
+    when the API budget runs low.
+    '''
+    if request.GET.get('output', 'html') == 'atom':
+        return friendfeed.BACKGROUND
+    return friendfeed.INTERACTIVE
+
+def queue_prefetch(request, next, method, *args):
+    '''Fetch the next page of a feed into the FriendFeed cache in the
+    background, so tapping "Next" doesn't wait on FriendFeed.
+
+    Only done with settings.FRIENDFEED_PREFETCH. method is the name of the
+    FriendFeed method the view called and args are its positional arguments.
+    '''
+    if not PREFETCH:
+        return
+    kwargs = request_to_feed_args_dict(request)
+    kwargs['start'] = next
+    nickname = request.session.get('nickname', None)
+    key = nickname and request.session.get('key', None)
+    if taskqueue is not None:
+        params = {
+            'method': method,
+            'args': simplejson.dumps([args, kwargs]),
+        }
+        if key:
+            # Tasks are stored and logged, so the remote key stays in
+            # memcache under a token that is only good for this prefetch
+            token = '%016x' % random.getrandbits(64)
+            memcache.set('prefetch/' + token, (nickname, key), PREFETCH_TOKEN_TIME)
+            params['token'] = token
+        taskqueue.add(url=reverse('prefetch'), params=params)
+    else:
+        f = friendfeed.FriendFeed(nickname, key)
+        future = f.prefetch(getattr(f, method), *args, **kwargs)
+        friendfeed.run_in_background(future.get_result)
+
+def prefetch(request):
+    '''Run a prefetch queued by queue_prefetch.
+
+    Only the task queue may call this.
+    '''
+    if not 'HTTP_X_APPENGINE_TASKNAME' in request.META:
+        raise Http404
+    method = request.POST['method']
+    if not method in PREFETCH_METHODS:
+        raise Http404
+    nickname, key = None, None
+    token = request.POST.get('token', None)
+    if token:
+        credentials = memcache.get('prefetch/' + token)
+        if credentials is None:
+            # Expired before the task ran; skip it rather than fetch the
+            # page signed out
+            return HttpResponse('')
+        memcache.delete('prefetch/' + token)
+        nickname, key = credentials
+    f = friendfeed.FriendFeed(nickname, key)
+    args, kwargs = simplejson.loads(request.POST['args'])
+    kwargs = dict((str(name), value) for name, value in kwargs.items())
+    f.prefetch(getattr(f, method), *args, **kwargs).get_result()
+    return HttpResponse('')
+
+def load_cursor(request):
+    '''Return the pagination cursor named by the cursor argument, or None.
+
+    A cursor only works for the user, page and feed arguments it was made
+    for.
+    '''
+    token = request.GET.get('cursor', None)
+    if not token:
+        return None
+    cursor = memcache.get('cursor/' + token)
+    if (cursor is None or
+        cursor['nickname'] != request.session.get('nickname', None) or
+        cursor['path'] != request.path or
+        cursor['args'] != cursor_args(request)):
+        return None
+    return cursor
+
+def save_cursor(request, cursor):
+    '''Store a pagination cursor for CURSOR_TIME and return its token.
+
+    cursor holds the FriendFeed offset after the entries fetched so far
+    ('start'), the ID of the last entry fetched before the ones left over
+    ('last'), and the left over entries ('buffer').
+    '''
+    token = '%016x' % random.getrandbits(64)
+    cursor['nickname'] = request.session.get('nickname', None)
+    cursor['path'] = request.path
+    cursor['args'] = cursor_args(request)
+    memcache.set('cursor/' + token, cursor, CURSOR_TIME)
+    return token
+
+def cursor_args(request):
+    args = request_to_feed_args_dict(request)
+    args.pop('start', None)
+    return args
+
+def cached_page(request):
+    '''Return this page as last rendered for the signed in user, or None.
+
+    A page is only good until the user changes something; see
+    bump_generation. On a miss the request remembers where render_page
+    should keep the new rendering.
+    '''
+    nickname = request.session.get('nickname', None)
+    if not nickname:
+        return None
+    parts = [request.path, nickname]
+    parts.extend([(name, request.session.get(name, None)) for name in DISPLAY_SETTINGS])
+    parts.extend(sorted(request.GET.items()))
+    key = 'page/' + hashlib.md5(repr(parts)).hexdigest()
+    generation_key = 'generation/' + nickname
+    # One round trip for both
+    cached = memcache.get_multi([key, generation_key])
+    generation = cached.get(generation_key, 0)
+    page = cached.get(key, None)
+    if page is not None and page[0] == generation:
+        generation, content, validators = page
+        if validators:
+            return not_modified(request, validators) or set_validators(HttpResponse(content), validators)
+        return HttpResponse(content)
+    request.page_cache = (key, generation)
+    return None
+
+def render_page(request, template, extra_context, validators):
+    '''Render a feed page, keeping it for cached_page unless it is stale.
+
+    validators are from validate, or None for a page that is not a feed.
+    '''
+    response = render_to_response(template, extra_context, context_instance=RequestContext(request))
+    if validators:
+        set_validators(response, validators)
+    page_cache = getattr(request, 'page_cache', None)
+    if page_cache and not extra_context.get('stale', False):
+        key, generation = page_cache
+        memcache.set(key, (generation, response.content, validators), PAGE_CACHE_TIME)
+    return response
+
+def bump_generation(request):
+    '''Drop the signed in user's cached pages after they change something.'''
+    key = 'generation/' + request.session['nickname']
+    if memcache.incr(key) is None:
+        memcache.add(key, 1)
+
+def validate(request, entries, *extra):
+    '''Return the validators (ETag and Last-Modified) of a feed page, and a
+    304 response to send instead of the page if the client has it already.
+
+    The ETag covers the entries' IDs and update times, the URL, the viewer,
+    their display settings and anything in extra that the page also shows.
+    Last-Modified is the newest entry's update time, and as it says nothing
+    about the rest, it is only given for pages that are the entries alone:
+    signed out, with default display settings and nothing true in extra.
+    '''
+    nickname = request.session.get('nickname', None)
+    display = [request.session.get(name, None) for name in DISPLAY_SETTINGS]
+    parts = [request.get_full_path(), nickname]
+    parts.extend(display)
+    parts.extend(extra)
+    parts.extend([(entry['id'], str(entry['updated'])) for entry in entries])
+    etag = '"%s"' % hashlib.md5(repr(parts)).hexdigest()
+    last_modified = None
+    if (entries and nickname is None and
+        not [value for value in tuple(display) + extra if value]):
+        updated = max([entry['updated'] for entry in entries])
+        last_modified = formatdate(calendar.timegm(updated.utctimetuple()), usegmt=True)
+    validators = (etag, last_modified)
+    return validators, not_modified(request, validators)
+
+def not_modified(request, validators):
+    '''Return a 304 response if the request's If-None-Match or, without
+    one, If-Modified-Since header matches validators, else None.
+    '''
+    etag, last_modified = validators
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH', None)
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        if not etag in tags and not '*' in tags:
+            return None
+    else:
+        if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE', None)
+        if not if_modified_since or not last_modified:
+            return None
+        since = parsedate_tz(if_modified_since)
+        if not since or mktime_tz(since) < mktime_tz(parsedate_tz(last_modified)):
+            return None
+    return set_validators(HttpResponseNotModified(), validators)
+
+def set_validators(response, validators):
+    etag, last_modified = validators
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = last_modified
+    return response
+
 def atom(entries):
     '''Build and return an Atom feed.
 
@@ -89,6 +332,7 @@ def comment_delete(request, entry, comment):
     data = f.delete_comment(entry, comment)
     if 'errorCode' in data:
         return error(request, data)
+    bump_generation(request)
     next = reverse('entry', args=[entry])
     args = {
         'message': 'deleted',
@@ -113,6 +357,7 @@ def comment_undelete(request, entry, comment):
     data = f.undelete_comment(entry, comment)
     if 'errorCode' in data:
         return error(request, data)
+    bump_generation(request)
     next = reverse('entry', args=[entry])
     args = {
         'message': 'commented',
@@ -137,6 +382,7 @@ def entry(request, entry):
         return error(request, data)
     extra_context = {
         'entries': data['entries'],
+        'stale': data.get('stale', False),
         'permalink': True,
         'title': data['entries'][0]['title'],
     }
@@ -165,6 +411,7 @@ def entry_comment(request, entry):
                 data = f.add_comment(form.data['entry'], form.data['body'], via=VIA)
             if 'errorCode' in data:
                 return error(request, data)
+            bump_generation(request)
             next = form.data['next']
             comment = data['id']
             args = {
@@ -201,6 +448,7 @@ def entry_delete(request, entry):
     data = f.delete_entry(entry)
     if 'errorCode' in data:
         return error(request, data)
+    bump_generation(request)
     next = request.GET.get('next', '/')
     if next == reverse('entry', args=[entry]):
         next = '/'
@@ -225,6 +473,7 @@ def entry_undelete(request, entry):
     data = f.undelete_entry(entry)
     if 'errorCode' in data:
         return error(request, data)
+    bump_generation(request)
     next = reverse('entry', args=[entry])
     args = {
         'message': 'shared',
@@ -247,6 +496,7 @@ def entry_hide(request, entry):
     data = f.hide_entry(entry)
     if 'errorCode' in data:
         return error(request, data)
+    bump_generation(request)
     next = request.GET.get('next', '/')
     args = {
         'message': 'hidden',
@@ -269,6 +519,7 @@ def entry_like(request, entry):
     data = f.add_like(entry)
     if 'errorCode' in data:
         return error(request, data)
+    bump_generation(request)
     next = reverse('entry', args=[entry])
     args = {
         'message': 'liked',
@@ -291,6 +542,7 @@ def entry_unhide(request, entry):
     data = f.unhide_entry(entry)
     if 'errorCode' in data:
         return error(request, data)
+    bump_generation(request)
     next = request.GET.get('next', '/')
     args = {
         'message': 'un-hidden',
@@ -313,6 +565,7 @@ def entry_unlike(request, entry):
     data = f.delete_like(entry)
     if 'errorCode' in data:
         return error(request, data)
+    bump_generation(request)
     next = reverse('entry', args=[entry])
     args = {
         'message': 'un-liked',
@@ -328,39 +581,103 @@ def home(request):
     '''
     if not request.session.get('nickname', None):
         return HttpResponseRedirect(reverse('login'))
+    page = cached_page(request)
+    if page:
+        return page
     f = friendfeed.FriendFeed(request.session['nickname'],
         request.session['key'])
+    f.priority = request_priority(request)
     start = max(get_integer_argument(request, 'start', 0), 0)
     num = get_integer_argument(request, 'num', NUM)
-    data = f.fetch_home_feed(**request_to_feed_args_dict(request))
-    if 'errorCode' in data:
-        return error(request, data)
-    entries = [entry for entry in data['entries'] if not entry['hidden']]
-    hidden = [entry for entry in data['entries'] if entry['hidden']]
-    new_start = start
-    while len(entries) < num and (new_start - start) / num < 3:
-        new_start = new_start + num
-        kwargs = request_to_feed_args_dict(request)
-        kwargs['start'] = new_start
-        data = f.fetch_home_feed(**kwargs)
-        if 'errorCode' in data:
+    # Pick up where the previous page left off: entries fetched but not
+    # shown yet, and the FriendFeed offset after them
+    cursor = load_cursor(request)
+    if cursor:
+        fetched = cursor['buffer']
+        upstream = cursor['start']
+        last = cursor['last']
+    else:
+        fetched = []
+        upstream = start
+        last = None
+    stale = False
+    pages = 0
+    done = False
+    while pages < HOME_MAX_PAGES and not done:
+        shown = len([entry for entry in fetched if not entry['hidden']])
+        if shown >= num:
+            break
+        # Guess how many more pages it takes to fill this one from the
+        # share of entries hidden so far, and fetch them all at once
+        if not fetched:
+            more = 1
+        elif shown:
+            ratio = float(shown) / len(fetched)
+            more = int(math.ceil((num - shown) / (ratio * num)))
+        else:
+            more = HOME_MAX_PAGES
+        more = min(more, HOME_MAX_PAGES - pages)
+        futures = []
+        for i in range(more):
+            kwargs = request_to_feed_args_dict(request)
+            kwargs['start'] = upstream + i * num
+            futures.append(f.call_async(f.fetch_home_feed, **kwargs))
+        pages += more
+        for data in friendfeed.wait_all(*futures):
+            if 'errorCode' in data:
+                if not fetched:
+                    return error(request, data)
+                # Later pages would leave a gap, so stop here
+                done = True
+                break
+            upstream += num
+            page = data['entries']
+            if not page:
+                done = True
+                break
+            # New entries push older ones down the feed, so skip any we
+            # already have
+            ids = [entry['id'] for entry in page]
+            if last in ids:
+                page = page[ids.index(last) + 1:]
+            seen = set([entry['id'] for entry in fetched])
+            fetched.extend([entry for entry in page if not entry['id'] in seen])
+            stale = stale or data.get('stale', False)
+    entries = []
+    hidden = []
+    buffer = []
+    for i, entry in enumerate(fetched):
+        if entry['hidden']:
+            hidden.append(entry)
+        elif len(entries) < num:
+            entries.append(entry)
+        else:
+            buffer = fetched[i:]
             break
-        more_entries = [entry for entry in data['entries'] if not entry['hidden']]
-        more_hidden = [entry for entry in data['entries'] if entry['hidden']]
-        entries.extend(more_entries)
-        hidden.extend(more_hidden)
-    entries = entries[:num]
     extra_context = {
         'entries': entries,
-        'next': start + len(entries) + len(hidden),
+        'stale': stale,
+        'next': upstream - len(buffer),
         'hidden': hidden,
     }
     if start > 0:
         extra_context['has_previous'] = True
         extra_context['previous'] = max(start - num, 0)
+    validators, response = validate(request, entries + hidden, extra_context['stale'])
+    if response:
+        return response
     if request.GET.get('output', 'html') == 'atom':
-        return atom(entries)
-    return render_to_response('home.html', extra_context, context_instance=RequestContext(request))
+        return set_validators(atom(entries), validators)
+    if fetched:
+        extra_context['cursor'] = save_cursor(request, {
+            'buffer': buffer,
+            'start': upstream,
+            'last': fetched[-len(buffer) - 1]['id'],
+        })
+    response = render_page(request, 'home.html', extra_context, validators)
+    if len(buffer) < num:
+        queue_prefetch(request, upstream, 'fetch_home_feed')
+    return response
 
 def login(request):
     '''Log a user in.
@@ -389,29 +706,135 @@ def logout(request):
     request.session['key'] = None
     return HttpResponseRedirect('/')
 
+def metrics(request):
+    '''Show FriendFeed API latency, size and status percentiles by endpoint.
+
+    Only App Engine administrators may see this; other Google users get a
+    403, since signing in again would just bring them back here.
+    '''
+    if not users.is_current_user_admin():
+        if users.get_current_user() is None:
+            return HttpResponseRedirect(users.create_login_url(request.path))
+        response = render_to_response('403.html', context_instance=RequestContext(request))
+        response.status_code = 403
+        return response
+    sink = friendfeed.metrics_sink()
+    rows = []
+    if hasattr(sink, 'histograms') and hasattr(sink, 'clear'):
+        if request.method == 'POST':
+            sink.clear()
+            return HttpResponseRedirect(reverse('metrics'))
+        for (endpoint, name), histogram in sorted(sink.histograms().items()):
+            count, (p50, p95, p99) = friendfeed.percentiles(histogram)
+            if name in ('network', 'decode', 'dates'):
+                # Seconds, shown in milliseconds
+                p50, p95, p99 = [int(value * 1000) for value in (p50, p95, p99)]
+            else:
+                p50, p95, p99 = [int(value) for value in (p50, p95, p99)]
+            rows.append({
+                'endpoint': endpoint,
+                'name': name,
+                'count': count,
+                'p50': p50,
+                'p95': p95,
+                'p99': p99,
+            })
+    extra_context = {
+        'rows': rows,
+    }
+    return render_to_response('metrics.html', extra_context, context_instance=RequestContext(request))
+
 def public(request):
     ''' Render the public feed.
 
     Authentication is not required and not used.  Memcache saves this data so
-    we don't have to hit FriendFeed as often for it.
+    we don't have to hit FriendFeed as often for it: each page is shared by
+    every visitor for PUBLIC_CACHE_TIME, then shown for up to
+    PUBLIC_GRACE_TIME more while one background task refreshes it.
     '''
-    f = friendfeed.FriendFeed()
     start = max(get_integer_argument(request, 'start', 0), 0)
     num = get_integer_argument(request, 'num', NUM)
-    data = f.fetch_public_feed(**request_to_feed_args_dict(request))
+    kwargs = request_to_feed_args_dict(request)
+    key = public_cache_key(kwargs)
+    cached = memcache.get(key)
+    if cached is None:
+        data = fetch_public_feed(kwargs, request_priority(request))
+    else:
+        fresh_until, data = cached
+        # The first visitor after it goes stale starts the only refresh
+        if fresh_until < time.time() and memcache.add(key + '/refresh', 1, PUBLIC_CACHE_TIME):
+            queue_public_refresh(kwargs)
     if 'errorCode' in data:
       return error(request, data)
     entries = data['entries']
     extra_context = {
         'entries': entries,
+        'stale': data.get('stale', False),
         'next': start + num,
     }
     if start > 0:
         extra_context['has_previous'] = True
         extra_context['previous'] = max(start - num, 0)
+    validators, response = validate(request, entries, extra_context['stale'])
+    if response:
+        return response
     if request.GET.get('output', 'html') == 'atom':
-        return atom(entries)
-    return render_to_response('public.html', extra_context, context_instance=RequestContext(request))
+        return set_validators(atom(entries), validators)
+    response = render_to_response('public.html', extra_context, context_instance=RequestContext(request))
+    set_validators(response, validators)
+    if PREFETCH:
+        # public reads its own shared copies, not the client's cache, so
+        # warm the next page's copy unless it is fresh or being refreshed
+        next_kwargs = dict(kwargs)
+        next_kwargs['start'] = str(extra_context['next'])
+        next_key = public_cache_key(next_kwargs)
+        cached = memcache.get(next_key)
+        if ((cached is None or cached[0] < time.time()) and
+            memcache.add(next_key + '/refresh', 1, PUBLIC_CACHE_TIME)):
+            queue_public_refresh(next_kwargs)
+    return response
+
+def public_cache_key(kwargs):
+    return 'public/' + hashlib.md5(repr(sorted(kwargs.items()))).hexdigest()
+
+def fetch_public_feed(kwargs, priority):
+    '''Fetch a page of the public feed and share it with public's visitors.
+
+    The client's own cache is skipped, or a refresh could share a copy
+    that was already old.
+    '''
+    f = friendfeed.FriendFeed(cache=False)
+    f.priority = priority
+    data = f.fetch_public_feed(**kwargs)
+    if not 'errorCode' in data and not data.get('stale', False):
+        memcache.set(public_cache_key(kwargs), (time.time() + PUBLIC_CACHE_TIME, data),
+            PUBLIC_CACHE_TIME + PUBLIC_GRACE_TIME)
+    return data
+
+def queue_public_refresh(kwargs):
+    '''Refresh a page of the shared public feed in the background.'''
+    if taskqueue is not None:
+        taskqueue.add(url=reverse('public_refresh'), params={
+            'args': simplejson.dumps(kwargs),
+        })
+    else:
+        friendfeed.run_in_background(public_refresh_now, kwargs)
+
+def public_refresh(request):
+    '''Run a refresh queued by queue_public_refresh.
+
+    Only the task queue may call this.
+    '''
+    if not 'HTTP_X_APPENGINE_TASKNAME' in request.META:
+        raise Http404
+    kwargs = simplejson.loads(request.POST['args'])
+    public_refresh_now(dict((str(name), value) for name, value in kwargs.items()))
+    return HttpResponse('')
+
+def public_refresh_now(kwargs):
+    fetch_public_feed(kwargs, friendfeed.BACKGROUND)
+    # Let the next visitor after this copy goes stale refresh it again
+    memcache.delete(public_cache_key(kwargs) + '/refresh')
 
 def related(request):
     url = request.GET.get('url', None)
@@ -422,21 +845,30 @@ def related(request):
             request.session['key'])
     else:
         f = friendfeed.FriendFeed()
+    f.priority = request_priority(request)
     start = max(get_integer_argument(request, 'start', 0), 0)
     num = get_integer_argument(request, 'num', NUM)
     data = f.fetch_url_feed(url, **request_to_feed_args_dict(request))
     if 'errorCode' in data:
         return error(request, data)
+    entries = data['entries']
     extra_context = {
-        'entries': data['entries'],
+        'entries': entries,
+        'stale': data.get('stale', False),
         'next': start + num,
     }
     if start > 0:
         extra_context['has_previous'] = True
         extra_context['previous'] = max(start - num, 0)
+    validators, response = validate(request, entries, extra_context['stale'])
+    if response:
+        return response
     if request.GET.get('output', 'html') == 'atom':
-        return atom(entries)
-    return render_to_response('related.html', extra_context, context_instance=RequestContext(request))
+        return set_validators(atom(entries), validators)
+    response = render_to_response('related.html', extra_context, context_instance=RequestContext(request))
+    set_validators(response, validators)
+    queue_prefetch(request, extra_context['next'], 'fetch_url_feed', url)
+    return response
 
 def room(request, nickname):
     '''Render a room feed.
@@ -450,16 +882,20 @@ def room(request, nickname):
             request.session['key'])
     else:
         f = friendfeed.FriendFeed()
+    f.priority = request_priority(request)
     start = max(get_integer_argument(request, 'start', 0), 0)
     num = get_integer_argument(request, 'num', NUM)
-    data = f.fetch_room_feed(nickname, **request_to_feed_args_dict(request))
+    # Fetch the feed and the profile at the same time
+    data, profile = friendfeed.wait_all(
+        f.call_async(f.fetch_room_feed, nickname, **request_to_feed_args_dict(request)),
+        f.call_async(f.fetch_room_profile, nickname))
     if 'errorCode' in data:
         return error(request, data)
-    profile = f.fetch_room_profile(nickname)
     entries = [entry for entry in data['entries'] if not entry['hidden']]
     hidden = [entry for entry in data['entries'] if entry['hidden']]
     extra_context = {
         'entries': entries,
+        'stale': data.get('stale', False),
         'next': start + num,
         'hidden': hidden,
         'profile': profile,
@@ -468,9 +904,15 @@ def room(request, nickname):
     if start > 0:
         extra_context['has_previous'] = True
         extra_context['previous'] = max(start - num, 0)
+    validators, response = validate(request, entries + hidden, extra_context['stale'], profile)
+    if response:
+        return response
     if request.GET.get('output', 'html') == 'atom':
-        return atom(entries)
-    return render_to_response('room.html', extra_context, context_instance=RequestContext(request))
+        return set_validators(atom(entries), validators)
+    response = render_to_response('room.html', extra_context, context_instance=RequestContext(request))
+    set_validators(response, validators)
+    queue_prefetch(request, extra_context['next'], 'fetch_room_feed', nickname)
+    return response
 
 def list(request, nickname):
     '''Render a list feed.
@@ -479,18 +921,25 @@ def list(request, nickname):
     '''
     if not request.session.get('nickname', None):
         return HttpResponseRedirect(reverse('login'))
+    page = cached_page(request)
+    if page:
+        return page
     f = friendfeed.FriendFeed(request.session['nickname'],
         request.session['key'])
+    f.priority = request_priority(request)
     start = max(get_integer_argument(request, 'start', 0), 0)
     num = get_integer_argument(request, 'num', NUM)
-    data = f.fetch_list_feed(nickname, **request_to_feed_args_dict(request))
+    # Fetch the feed and the profile at the same time
+    data, profile = friendfeed.wait_all(
+        f.call_async(f.fetch_list_feed, nickname, **request_to_feed_args_dict(request)),
+        f.call_async(f.fetch_list_profile, nickname))
     if 'errorCode' in data:
         return error(request, data)
-    profile = f.fetch_list_profile(nickname)
     entries = [entry for entry in data['entries'] if not entry['hidden']]
     hidden = [entry for entry in data['entries'] if entry['hidden']]
     extra_context = {
         'entries': entries,
+        'stale': data.get('stale', False),
         'next': start + num,
         'hidden': hidden,
         'profile': profile,
@@ -499,9 +948,14 @@ def list(request, nickname):
     if start > 0:
         extra_context['has_previous'] = True
         extra_context['previous'] = max(start - num, 0)
+    validators, response = validate(request, entries + hidden, extra_context['stale'], profile)
+    if response:
+        return response
     if request.GET.get('output', 'html') == 'atom':
-        return atom(entries)
-    return render_to_response('list.html', extra_context, context_instance=RequestContext(request))
+        return set_validators(atom(entries), validators)
+    response = render_page(request, 'list.html', extra_context, validators)
+    queue_prefetch(request, extra_context['next'], 'fetch_list_feed', nickname)
+    return response
 
 def lists(request):
     '''Display the authenticated users lists
@@ -527,6 +981,9 @@ def rooms(request):
     '''
     if not request.session.get('nickname', None):
         return HttpResponseRedirect(reverse('login'))
+    page = cached_page(request)
+    if page:
+        return page
     f = friendfeed.FriendFeed(request.session['nickname'],
         request.session['key'])
     if 'list' in request.GET:
@@ -535,6 +992,7 @@ def rooms(request):
             extra_context = {
                 'rooms': data['rooms'],
             }
+            validators = None
             template = 'rooms_list.html'
     else:
         start = max(get_integer_argument(request, 'start', 0), 0)
@@ -545,16 +1003,23 @@ def rooms(request):
             hidden = [entry for entry in data['entries'] if entry['hidden']]
             extra_context = {
                 'entries': entries,
+                'stale': data.get('stale', False),
                 'hidden': hidden,
                 'next': start + num,
             }
             if start > 0:   
                 extra_context['has_previous'] = True
                 extra_context['previous'] = max(start - num, 0)
+            validators, response = validate(request, entries + hidden, extra_context['stale'])
+            if response:
+                return response
             template = 'rooms.html'
     if 'errorCode' in data:
         return error(request, data)
-    return render_to_response(template, extra_context, context_instance=RequestContext(request))
+    response = render_page(request, template, extra_context, validators)
+    if template == 'rooms.html':
+        queue_prefetch(request, extra_context['next'], 'fetch_rooms_feed')
+    return response
 
 def search(request):
     '''Render a search feed.
@@ -584,6 +1049,7 @@ def search(request):
             request.session['key'])
     else:
         f = friendfeed.FriendFeed()
+    f.priority = request_priority(request)
     start = max(get_integer_argument(request, 'start', 0), 0)
     num = get_integer_argument(request, 'num', NUM)
     q = form.data['q']
@@ -594,6 +1060,7 @@ def search(request):
     hidden = [entry for entry in data['entries'] if entry['hidden']]
     extra_context = {
         'entries': entries,
+        'stale': data.get('stale', False),
         'hidden': hidden,
         'next': start + num,
         'title': q,
@@ -602,9 +1069,14 @@ def search(request):
     if start > 0:
         extra_context['has_previous'] = True
         extra_context['previous'] = max(start - num, 0)
+    validators, response = validate(request, entries + hidden, extra_context['stale'])
+    if response:
+        return response
     if request.GET.get('output', 'html') == 'atom':
-        return atom(entries)
-    return render_to_response('search.html', extra_context, context_instance=RequestContext(request))
+        return set_validators(atom(entries), validators)
+    response = render_to_response('search.html', extra_context, context_instance=RequestContext(request))
+    set_validators(response, validators)
+    return response
 
 def settings(request):
     '''Set a number of settings.
@@ -649,6 +1121,7 @@ def share(request):
             data = f.publish_message(request.POST['title'], via=VIA, room=request.POST.get('room', None))
             if 'errorCode' in data:
                 return error(request, data)
+            bump_generation(request)
     next = reverse('entry', args=[data['entries'][0]['id']])
     args = {
         'message': 'shared',
@@ -682,21 +1155,26 @@ def user(request, nickname, type=None):
     else:
         f = friendfeed.FriendFeed()
         subscribed = False
+    f.priority = request_priority(request)
     start = max(get_integer_argument(request, 'start', 0), 0)
     num = get_integer_argument(request, 'num', NUM)
     kwargs = request_to_feed_args_dict(request)
     if type == 'comments':
-        data = f.fetch_user_comments_feed(nickname, **kwargs)
+        fetch_feed = f.fetch_user_comments_feed
     elif type == 'likes':
-        data = f.fetch_user_likes_feed(nickname, **kwargs)
+        fetch_feed = f.fetch_user_likes_feed
     elif type == 'discussion':
-        data = f.fetch_user_discussion_feed(nickname, **kwargs)
+        fetch_feed = f.fetch_user_discussion_feed
     elif type == 'friends':
-        data = f.fetch_user_friends_feed(nickname, **kwargs)
+        fetch_feed = f.fetch_user_friends_feed
     else:
-        data = f.fetch_user_feed(nickname, **kwargs)
+        fetch_feed = f.fetch_user_feed
+    # Fetch the feed and the profile at the same time
+    data = f.call_async(fetch_feed, nickname, **kwargs)
+    profile = f.call_async(f.fetch_user_profile, nickname)
+    data = data.get_result()
     try:
-        profile = f.fetch_user_profile(nickname)
+        profile = profile.get_result()
     except:
         profile = {
             'name': data['entries'][0]['user']['name'],
@@ -707,6 +1185,7 @@ def user(request, nickname, type=None):
     hidden = [entry for entry in data['entries'] if entry['hidden']]
     extra_context = {
         'entries': entries,
+        'stale': data.get('stale', False),
         'hidden': hidden,
         'next': start + num,
         'profile': profile,
@@ -716,9 +1195,15 @@ def user(request, nickname, type=None):
     if start > 0:
         extra_context['has_previous'] = True
         extra_context['previous'] = max(start - num, 0)
+    validators, response = validate(request, entries + hidden, extra_context['stale'], profile, subscribed)
+    if response:
+        return response
     if request.GET.get('output', 'html') == 'atom':
-        return atom(entries)
-    return render_to_response('user.html', extra_context, context_instance=RequestContext(request))
+        return set_validators(atom(entries), validators)
+    response = render_to_response('user.html', extra_context, context_instance=RequestContext(request))
+    set_validators(response, validators)
+    queue_prefetch(request, extra_context['next'], fetch_feed.__name__, nickname)
+    return response
 
 def user_subscribe(request, nickname):
     '''Subscribe to a user.
@@ -734,6 +1219,7 @@ def user_subscribe(request, nickname):
     data = f.user_subscribe(nickname)
     if 'errorCode' in data:
         return error(request, data)
+    bump_generation(request)
     memcache.delete('profile/' + request.session['nickname'])
     args = {
         'message': data.get('status', '')
@@ -754,6 +1240,7 @@ def user_unsubscribe(request, nickname):
     data = f.user_unsubscribe(nickname)
     if 'errorCode' in data:
         return error(request, data)
+    bump_generation(request)
     memcache.delete('profile/' + request.session['nickname'])
     args = {
         'message': data.get('status', '')
@@ -23,6 +23,9 @@ urlpatterns = patterns('',
     url(r'^share/$', 'fftogo.views.share', name='share'),
     url(r'^search/$', 'fftogo.views.search', name='search'),
     url(r'^related/$', 'fftogo.views.related', name='related'),
+    url(r'^metrics/$', 'fftogo.views.metrics', name='metrics'),
+    url(r'^tasks/prefetch/$', 'fftogo.views.prefetch', name='prefetch'),
+    url(r'^tasks/public/$', 'fftogo.views.public_refresh', name='public_refresh'),
     url(r'^(?P<nickname>[\w-]+)/$', 'fftogo.views.user', name='user'),
     url(r'^(?P<nickname>\w+)/subscribe/$', 'fftogo.views.user_subscribe', name='user_subscribe'),
     url(r'^(?P<nickname>\w+)/unsubscribe/$', 'fftogo.views.user_unsubscribe', name='user_unsubscribe'),